@@ -0,0 +1,14 @@
+import re
+
+# A 0x-prefixed, 20-byte hex address; checksum casing is accepted but not verified
+ADDRESS_RE = re.compile(r'^0x[a-fA-F0-9]{40}$')
+
+
+def is_valid_address(address):
+    """
+    Check whether a string is a well-formed Ethereum address.
+
+    :param address: str, address to check
+    :return: bool, True if the address is 0x followed by 40 hex digits
+    """
+    return isinstance(address, str) and ADDRESS_RE.match(address) is not None
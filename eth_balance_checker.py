@@ -1,53 +1,105 @@
+import csv
 import pandas as pd
 import requests
-import json
-import re
-import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import repeat
+from eth_address import ADDRESS_RE
+from http_session import create_session, json_loads
+from rate_limiter import ETHERSCAN_RATE_LIMIT, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+_WEI = 10**18
 
 class CryptoBalanceChecker:
-    def __init__(self, config_file):
-        with open(config_file, 'r') as config_file:
-            config = json.load(config_file)
+    MAX_WORKERS = 8
+
+    def __init__(self, config_file=None, config=None, session=None, limiter=None):
+        if config is None:
+            with open(config_file, 'rb') as config_file:
+                config = json_loads(config_file.read())
         self.api_url = config['api_url']
         self.api_key = config['api_key']
         self.coingecko_api_key = config['coingecko_api_key']
         self.input_filename = config['filename']
+        self.rpc_url = config.get('rpc_url')
+        self.batch_size = config.get('batch_size', 25)
         self.current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.output_filename = f"wallet_balances_{self.current_time}.csv"
-
-    @staticmethod
-    def is_valid_ethereum_address(address):
-        """
-        Validate the format of an Ethereum address.
-
-        :param address: str, Ethereum wallet address
-        :return: bool, True if the address is valid, False otherwise
-        """
-        if re.match(r'^0x[a-fA-F0-9]{40}$', address):
-            return True
-        return False
+        # A session passed in by the caller is shared and stays open after processing
+        self.owns_session = session is None
+        self.session = create_session() if session is None else session
+        # Pass the same limiter to every checker that talks to Etherscan so their requests share one budget
+        self.limiter = RateLimiter(ETHERSCAN_RATE_LIMIT) if limiter is None else limiter
 
     def get_eth_balance(self, wallet_address):
         """
         Retrieve the Ethereum balance for a given wallet address using Etherscan's API.
 
         :param wallet_address: str, Ethereum wallet address
-        :return: float, Ethereum balance in Ether
+        :return: int, Ethereum balance in wei
         """
         endpoint = f"{self.api_url}?module=account&action=balance&address={wallet_address}&tag=latest&apikey={self.api_key}"
-        response = requests.get(endpoint)
+        # Only the first attempt takes a limiter token; urllib3 retries inside the session bypass it
+        with self.limiter:
+            response = self.session.get(endpoint)
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             if data['status'] == '1':
-                balance_wei = int(data['result'])
-                balance_ether = balance_wei / 10**18
-                return balance_ether
+                return int(data['result'])
             else:
                 raise ValueError(f"Error from Etherscan API: {data['message']} - {data['result']}")
         else:
             raise Exception(f"Failed to retrieve data: {response.status_code}")
 
+    def _rpc_batch(self, addresses):
+        """
+        Retrieve Ethereum balances for a batch of addresses with a single JSON-RPC request.
+
+        :param addresses: list, Ethereum wallet addresses
+        :return: dict, Ethereum balance in wei keyed by wallet address, or None if the endpoint does not support batching or fails
+        """
+        calls = [
+            {"jsonrpc": "2.0", "id": i, "method": "eth_getBalance", "params": [address, "latest"]}
+            for i, address in enumerate(addresses)
+        ]
+        try:
+            response = self.session.post(self.rpc_url, json=calls)
+            data = json_loads(response.content)
+        except requests.RequestException as e:
+            logger.warning("RPC batch request failed: %s", e)
+            return None
+        except ValueError:
+            return None
+        if not isinstance(data, list):
+            return None
+        balances = {}
+        for item in data:
+            # Error entries may carry a null id or result; those addresses fall back to Etherscan
+            if not isinstance(item, dict):
+                continue
+            item_id, result = item.get('id'), item.get('result')
+            if isinstance(item_id, int) and 0 <= item_id < len(addresses) and isinstance(result, str):
+                balances[addresses[item_id]] = int(result, 16)
+        return balances
+
+    def get_eth_balances(self, addresses):
+        """
+        Retrieve Ethereum balances for many addresses using batched JSON-RPC eth_getBalance calls.
+
+        :param addresses: list, Ethereum wallet addresses
+        :return: dict, Ethereum balance in wei keyed by wallet address, or None if the endpoint does not support batching
+        """
+        balances = {}
+        for start in range(0, len(addresses), self.batch_size):
+            batch = self._rpc_batch(addresses[start:start + self.batch_size])
+            if batch is None:
+                return None
+            balances.update(batch)
+        return balances
+
     def get_eth_price(self):
         """
         Retrieve the current price of Ethereum using the CoinGecko API, with rate limit handling.
@@ -55,70 +107,86 @@ class CryptoBalanceChecker:
         :return: float, current price of Ethereum in USD
         """
         coingecko_url = "https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd"
-        retries = 5
-        delay = 62
-        for attempt in range(retries):
-            try:
-                response = requests.get(coingecko_url)
-                if response.status_code == 200:
-                    data = response.json()
-                    eth_price = data['ethereum']['usd']
-                    return eth_price
-                elif response.status_code == 429:
-                    print(f"Rate limit exceeded. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                    delay *= 2
-                else:
-                    raise Exception(f"Failed to retrieve Ethereum price: {response.status_code}")
-            except requests.RequestException as e:
-                print(f"Request error: {e}. Retrying in {delay} seconds...")
-                time.sleep(delay)
-                delay *= 2
-        raise Exception("Failed to retrieve Ethereum price after multiple attempts")
+        response = self.session.get(coingecko_url)
+        if response.status_code == 200:
+            data = json_loads(response.content)
+            return data['ethereum']['usd']
+        raise Exception(f"Failed to retrieve Ethereum price: {response.status_code}")
+
+    def fetch_balance(self, i, total, address):
+        """
+        Retrieve the balance of a single wallet, logging instead of raising on failure.
+
+        :param i: int, index of the address among the unique addresses
+        :param total: int, number of unique addresses
+        :param address: str, Ethereum wallet address
+        :return: int, Ethereum balance in wei, or None if it could not be retrieved
+        """
+        logger.debug("Processing %d/%d: %s", i + 1, total, address)
+        try:
+            balance = self.get_eth_balance(address)
+            logger.debug("Balance for %s: %s wei", address, balance)
+            return balance
+        except ValueError as ve:
+            logger.warning("Error retrieving balance for %s: %s", address, ve)
+        except Exception as e:
+            logger.error("Unexpected error for %s: %s", address, e)
+        return None
 
     def process_wallets(self):
         """
         Process the wallets and save the results to a CSV file.
+
+        :return: pandas.DataFrame, balance and value of every wallet in the input file
         """
-        wallet_df = pd.read_csv(self.input_filename)
-        wallet_balances = []
-        print("Starting to retrieve balances for wallet addresses...\n")
+        wallet_df = pd.read_csv(self.input_filename, dtype=str, keep_default_na=False)
+        normalized = wallet_df['wallet_address'].str.lower()
+        valid = normalized.str.match(ADDRESS_RE, na=False)
+        for address in wallet_df.loc[~valid, 'wallet_address']:
+            logger.warning("Invalid Ethereum address: %s", address)
+        addresses = list(normalized[valid].unique())
+        logger.info("Starting to retrieve balances for %d unique wallet addresses...", len(addresses))
         eth_price = self.get_eth_price()
-        print(f"Current Ethereum price: ${eth_price:.2f} USD\n")
-        for i, row in wallet_df.iterrows():
-            address = row['wallet_address']
-            hardwarewallet = row['hardwarewallet']
-            print(f"Processing {i+1}/{len(wallet_df)}: {address}")
-            if not self.is_valid_ethereum_address(address):
-                print(f"Invalid Ethereum address: {address}")
-                wallet_balances.append({"wallet_address": address, "hardwarewallet": hardwarewallet, "balance_ether": None, "value_usd": None})
-                continue
-            try:
-                balance = self.get_eth_balance(address)
-                value_usd = balance * eth_price
-                print(f"Balance for {address}: {balance} Ether, Value: ${value_usd:.2f} USD")
-                wallet_balances.append({"wallet_address": address, "hardwarewallet": hardwarewallet, "balance_ether": balance, "value_usd": value_usd})
-            except ValueError as ve:
-                print(f"Error retrieving balance for {address}: {ve}")
-                wallet_balances.append({"wallet_address": address, "hardwarewallet": hardwarewallet, "balance_ether": None, "value_usd": None})
-            except Exception as e:
-                print(f"Unexpected error for {address}: {e}")
-                wallet_balances.append({"wallet_address": address, "hardwarewallet": hardwarewallet, "balance_ether": None, "value_usd": None})
-        balance_df = pd.DataFrame(wallet_balances)
-        total_balance = balance_df['balance_ether'].sum()
-        total_value = balance_df['value_usd'].sum()
-        summary_row = pd.DataFrame([{"wallet_address": "Total", "hardwarewallet": "", "balance_ether": total_balance, "value_usd": total_value}])
-        empty_row = pd.DataFrame([{"wallet_address": "", "hardwarewallet": "", "balance_ether": None, "value_usd": None}])
-        price_row = pd.DataFrame([{"wallet_address": "Ethereum Price", "hardwarewallet": "", "balance_ether": None, "value_usd": eth_price}])
-        timestamp_row = pd.DataFrame([{"wallet_address": "Timestamp", "hardwarewallet": "", "balance_ether": None, "value_usd": self.current_time}])
-        balance_df = pd.concat([balance_df, summary_row], ignore_index=True)
-        balance_df = pd.concat([balance_df, empty_row], ignore_index=True)
-        balance_df = pd.concat([balance_df, price_row], ignore_index=True)
-        balance_df = pd.concat([balance_df, timestamp_row], ignore_index=True)
-        balance_df.to_csv(self.output_filename, index=False)
-        print(f"\nData saved to {self.output_filename}")
+        logger.info("Current Ethereum price: $%.2f USD", eth_price)
+
+        balances = {}
+        if self.rpc_url:
+            balances = self.get_eth_balances(addresses)
+            if balances is None:
+                logger.info("RPC endpoint does not support batch requests, falling back to per-address requests.")
+                balances = {}
+        remaining = [address for address in addresses if address not in balances]
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            balances.update(zip(remaining, executor.map(self.fetch_balance, range(len(remaining)), repeat(len(remaining)), remaining)))
+
+        # Balances stay in integer wei until they are written out
+        balance_wei = [balances.get(address) for address in normalized]
+        total_balance = sum(wei for wei in balance_wei if wei is not None) / _WEI
+        total_value = total_balance * eth_price
+        balance_ether = [None if wei is None else wei / _WEI for wei in balance_wei]
+        rows = [
+            (address, hardwarewallet, ether, None if ether is None else ether * eth_price)
+            for address, hardwarewallet, ether in zip(wallet_df['wallet_address'], wallet_df['hardwarewallet'], balance_ether)
+        ]
+        columns = ["wallet_address", "hardwarewallet", "balance_ether", "value_usd"]
+        footer = [
+            ("Total", "", total_balance, total_value),
+            ("", "", None, None),
+            ("Ethereum Price", "", None, eth_price),
+            ("Timestamp", "", None, self.current_time)
+        ]
+        with open(self.output_filename, 'w', newline='') as output_file:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(rows)
+            writer.writerows(footer)
+        if self.owns_session:
+            self.session.close()
+        logger.info("Data saved to %s", self.output_filename)
+        return pd.DataFrame(rows, columns=columns)
 
 # Example usage:
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     checker = CryptoBalanceChecker('config.json')
     checker.process_wallets()
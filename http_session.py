@@ -0,0 +1,49 @@
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# The ETH price lookup is cached briefly so quick re-runs reuse it; token prices
+# have their own per-contract cache in token_balance_checker
+PRICE_CACHE_TTL = 60
+
+
+def create_session():
+    """
+    Create a pooled HTTP session that retries rate-limited and failed requests.
+
+    Retries back off exponentially and honour the Retry-After header sent with HTTP 429 responses.
+    When requests-cache is installed, the CoinGecko ETH price is cached on disk for PRICE_CACHE_TTL seconds.
+
+    :return: requests.Session, session shared by all requests of a checker
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=1.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(["GET", "POST"])
+    )
+    if requests_cache is not None:
+        session = requests_cache.CachedSession(
+            '.http_cache',
+            backend='sqlite',
+            urls_expire_after={'api.coingecko.com/api/v3/simple/price': PRICE_CACHE_TTL, '*': requests_cache.DO_NOT_CACHE}
+        )
+    else:
+        session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=32))
+    session.headers.update({"Accept": "application/json", "User-Agent": "eth-token-balance-checker"})
+    return session
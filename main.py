@@ -1,12 +1,27 @@
+import logging
+from eth_address import ADDRESS_RE
+from http_session import create_session, json_loads
+from rate_limiter import ETHERSCAN_RATE_LIMIT, RateLimiter
 from token_balance_checker import TokenBalanceChecker
 from eth_balance_checker import CryptoBalanceChecker
 
 def main():
-    token_checker = TokenBalanceChecker('config.json')
-    token_balances, token_prices = token_checker.sum_token_balances_and_fetch_prices()
-    
-    crypto_checker = CryptoBalanceChecker('config.json')
-    crypto_checker.process_wallets()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    with open('config.json', 'rb') as config_file:
+        config = json_loads(config_file.read())
+
+    limiter = RateLimiter(ETHERSCAN_RATE_LIMIT)
+    with create_session() as session:
+        crypto_checker = CryptoBalanceChecker(config=config, session=session, limiter=limiter)
+        balance_df = crypto_checker.process_wallets()
+
+        # Wallets without any ETH and malformed addresses are skipped; wallets whose balance could not be
+        # retrieved are still checked
+        valid = balance_df['wallet_address'].str.match(ADDRESS_RE, na=False)
+        active = balance_df['balance_ether'].isna() | (balance_df['balance_ether'] > 0)
+        active_addresses = balance_df.loc[valid & active, 'wallet_address']
+        token_checker = TokenBalanceChecker(addresses=active_addresses, config=config, session=session, limiter=limiter)
+        token_balances, token_prices = token_checker.sum_token_balances_and_fetch_prices()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,39 @@
+import threading
+import time
+
+# Stay just under Etherscan's free-tier limit of 5 requests per second
+ETHERSCAN_RATE_LIMIT = 4
+
+
+class RateLimiter:
+    def __init__(self, rate, period=1.0):
+        """
+        Rate limiter that can be shared between worker threads.
+
+        Requests are spaced evenly, one every period / rate seconds, so there is no
+        initial burst and no window of one period ever sees more than rate + 1 requests.
+
+        :param rate: int, number of requests allowed per period
+        :param period: float, length of the period in seconds
+        """
+        self.interval = period / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until this caller's request slot is reached.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
@@ -1,41 +1,128 @@
+import csv
+import numpy as np
 import pandas as pd
 import requests
 import re
+import shelve
 import time
-import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from eth_address import is_valid_address
+from http_session import create_session, json_loads
+from rate_limiter import ETHERSCAN_RATE_LIMIT, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Token decimals are a uint8, so every scale factor can be looked up
+_POW10 = [10**i for i in range(256)]
+
+# Contract address -> (price, fetched_at), shared by every checker in the process
+_PRICE_CACHE = {}
+
+_SPAM_RE = re.compile(r'\bhttps?://\S+|\bwww\.[\w-]+\.\w+\b|\b[\w-]+\.\w+\b|visit\b|claim\b|reward\b', re.I)
 
 class TokenBalanceChecker:
-    def __init__(self, config_file):
-        with open(config_file, 'r') as config_file:
-            config = json.load(config_file)
+    MAX_WORKERS = 8
+    MAX_TOKEN_NAME_LENGTH = 50
+    PRICE_BATCH_SIZE = 100
+    METADATA_BATCH_SIZE = 100
+    # Etherscan only serves the first 10000 rows of a paginated tokentx query
+    TOKENTX_PAGE_SIZE = 1000
+    TOKENTX_RESULT_WINDOW = 10000
+    PRICE_CACHE_FILE = '.price_cache'
+    PRICE_CACHE_TTL = 300
+
+    def __init__(self, config_file=None, addresses=None, config=None, session=None, limiter=None):
+        if config is None:
+            with open(config_file, 'rb') as config_file:
+                config = json_loads(config_file.read())
         self.api_url = config['api_url']
         self.api_key = config['api_key']
         self.coingecko_api_key = config['coingecko_api_key']
         self.filename = config['filename']
+        self.addresses = addresses
+        self.alchemy_url = config.get('alchemy_url')
         self.current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.output_filename = f"token_data_{self.current_time}.csv"
+        # A session passed in by the caller is shared and stays open after processing
+        self.owns_session = session is None
+        self.session = create_session() if session is None else session
+        # Pass the same limiter to every checker that talks to Etherscan so their requests share one budget
+        self.limiter = RateLimiter(ETHERSCAN_RATE_LIMIT) if limiter is None else limiter
 
-    def get_token_price(self, contract_address, remaining_calls):
-        url = f"https://api.coingecko.com/api/v3/simple/token_price/ethereum?contract_addresses={contract_address}&vs_currencies=usd&x-api-key={self.coingecko_api_key}"
-        max_retries = 5
-        retry_delay = 65
-        print(f"Fetching price for {contract_address} (Remaining calls: {remaining_calls})")
-
-        for attempt in range(max_retries):
-            response = requests.get(url)
-            print(f"Attempt {attempt + 1} for price: HTTP status {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
-                return data.get(contract_address, {}).get('usd', "Price data not available")
-            elif response.status_code == 429:
-                print(f"Rate limit hit, sleeping for {retry_delay} seconds...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                break
+    @contextmanager
+    def open_price_cache(self):
+        # The disk cache is best effort: a locked, corrupted or unwritable file only costs extra price requests
+        try:
+            disk_cache = shelve.open(self.PRICE_CACHE_FILE)
+        except Exception as e:
+            logger.warning("Price cache %s unavailable: %s", self.PRICE_CACHE_FILE, e)
+            yield {}
+            return
+        try:
+            yield disk_cache
+        finally:
+            try:
+                disk_cache.close()
+            except Exception as e:
+                logger.warning("Could not save price cache %s: %s", self.PRICE_CACHE_FILE, e)
+
+    def is_fresh_price(self, entry, now):
+        return isinstance(entry, tuple) and len(entry) == 2 and now - entry[1] < self.PRICE_CACHE_TTL
+
+    def get_token_prices(self, contract_addresses):
+        url = "https://api.coingecko.com/api/v3/simple/token_price/ethereum"
+        contract_addresses = list(dict.fromkeys(addr.lower() for addr in contract_addresses))
+        prices = {}
+        now = time.time()
+
+        with self.open_price_cache() as disk_cache:
+            for addr in contract_addresses:
+                # Each layer is checked on its own so a stale in-memory entry never hides a fresher one on disk
+                cached = _PRICE_CACHE.get(addr)
+                if not self.is_fresh_price(cached, now):
+                    try:
+                        cached = disk_cache.get(addr)
+                    except Exception as e:
+                        logger.warning("Could not read cached price for %s: %s", addr, e)
+                        cached = None
+                if self.is_fresh_price(cached, now):
+                    prices[addr] = cached[0]
+                    _PRICE_CACHE[addr] = cached
+            missing = [addr for addr in contract_addresses if addr not in prices]
+            logger.debug("%d of %d token prices served from cache", len(prices), len(contract_addresses))
 
-        return "API request failed after retries"
+            for start in range(0, len(missing), self.PRICE_BATCH_SIZE):
+                chunk = missing[start:start + self.PRICE_BATCH_SIZE]
+                params = {
+                    'contract_addresses': ','.join(chunk),
+                    'vs_currencies': 'usd',
+                    'x-api-key': self.coingecko_api_key
+                }
+                logger.debug("Fetching prices for %d tokens (%d/%d)", len(chunk), start + len(chunk), len(missing))
+
+                try:
+                    response = self.session.get(url, params=params)
+                except requests.RequestException as e:
+                    logger.warning("Price request failed: %s", e)
+                    response = None
+                if response is not None and response.status_code == 200:
+                    data = {addr.lower(): info for addr, info in json_loads(response.content).items()}
+                    for addr in chunk:
+                        prices[addr] = data.get(addr, {}).get('usd', "Price data not available")
+                        _PRICE_CACHE[addr] = (prices[addr], now)
+                    try:
+                        for addr in chunk:
+                            disk_cache[addr] = _PRICE_CACHE[addr]
+                    except Exception as e:
+                        logger.warning("Could not write price cache %s: %s", self.PRICE_CACHE_FILE, e)
+
+                for addr in chunk:
+                    prices.setdefault(addr, "API request failed after retries")
+
+        return prices
 
     def get_token_balances(self, address):
         params = {
@@ -44,67 +131,166 @@ class TokenBalanceChecker:
             'address': address,
             'startblock': 0,
             'endblock': 999999999,
+            'page': 1,
+            'offset': self.TOKENTX_PAGE_SIZE,
             'sort': 'asc',
             'apikey': self.api_key
         }
-        print(f"Requesting token balances for {address}")
-        response = requests.get(self.api_url, params=params)
-        data = response.json()
-        if data.get('status') != '1' or 'result' not in data:
-            print(f"API error for address {address}: {data.get('result', 'No error message available')}")
+        transfers = []
+        logger.debug("Requesting token balances for %s", address)
+        while True:
+            # Only the first attempt takes a limiter token; urllib3 retries inside the session bypass it
+            with self.limiter:
+                response = self.session.get(self.api_url, params=params)
+            data = json_loads(response.content)
+            if data.get('status') != '1' or 'result' not in data:
+                if data.get('message') == 'No transactions found' and not data.get('result'):
+                    break
+                # Balances rebuilt from a partial transfer history would be wrong, so drop earlier pages too
+                logger.warning("API error for address %s: %s", address, data.get('result', 'No error message available'))
+                return []
+            result = data['result']
+            # Drop spam airdrops before they reach filter_tokens
+            transfers.extend(token for token in result if not _SPAM_RE.search(token.get('tokenName', '')))
+            if len(result) < self.TOKENTX_PAGE_SIZE:
+                break
+            if params['page'] * self.TOKENTX_PAGE_SIZE >= self.TOKENTX_RESULT_WINDOW:
+                logger.warning("Transfer history for %s exceeds %d rows; token balances are truncated", address, self.TOKENTX_RESULT_WINDOW)
+                break
+            params['page'] += 1
+        return transfers
+
+    def get_current_token_balances(self, address):
+        balances = []
+        page_key = None
+        logger.debug("Requesting current token balances for %s", address)
+        while True:
+            params = [address, "erc20"] + ([{"pageKey": page_key}] if page_key else [])
+            response = self.session.post(self.alchemy_url, json={"jsonrpc": "2.0", "id": 1, "method": "alchemy_getTokenBalances", "params": params})
+            data = json_loads(response.content)
+            if 'result' not in data:
+                logger.warning("API error for address %s: %s", address, data.get('error', 'No error message available'))
+                return []
+            balances.extend(b for b in data['result']['tokenBalances'] if int(b.get('tokenBalance') or '0x0', 16) > 0)
+            page_key = data['result'].get('pageKey')
+            if not page_key:
+                break
+        if not balances:
             return []
-        return data['result']
 
-    def filter_tokens(self, tokens, address):
+        metadata = {}
+        for start in range(0, len(balances), self.METADATA_BATCH_SIZE):
+            calls = [
+                {"jsonrpc": "2.0", "id": i, "method": "alchemy_getTokenMetadata", "params": [balances[i]['contractAddress']]}
+                for i in range(start, min(start + self.METADATA_BATCH_SIZE, len(balances)))
+            ]
+            response = self.session.post(self.alchemy_url, json=calls)
+            data = json_loads(response.content)
+            if not isinstance(data, list):
+                logger.warning("Token metadata request failed for %s: %s", address, data.get('error', 'No error message available') if isinstance(data, dict) else data)
+                continue
+            metadata.update((item['id'], item.get('result') or {}) for item in data if isinstance(item, dict) and isinstance(item.get('id'), int))
+
+        # Tokens without metadata are dropped, since their decimals are unknown
+        return [{
+            'contractAddress': b['contractAddress'].lower(),
+            'tokenName': metadata[i].get('name') or '',
+            'tokenSymbol': metadata[i].get('symbol') or '',
+            'tokenDecimal': metadata[i].get('decimals') or 0,
+            'balance': int(b['tokenBalance'], 16)
+        } for i, b in enumerate(balances) if i in metadata]
+
+    def filter_token_balances(self, balances, address):
         filtered = {}
-        max_length = 50
-        pattern = r'\bhttps?://\S+|\bwww\.[\w-]+\.\w+\b|\b[\w-]+\.\w+\b|visit\b|claim\b|reward\b'
-        print("Filtering tokens...")
-
-        for token in tokens:
-            token_name = token.get('tokenName', '')
-            token_symbol = token.get('tokenSymbol', '')
-            contract_address = token.get('contractAddress', '')
-            token_value = int(token.get('value', 0)) / (10 ** int(token.get('tokenDecimal', 0)))
-            
-            if not re.search(pattern, token_name, re.I) and len(token_name) <= max_length:
-                key = f"{token_symbol} ({token_name})"
-                if key not in filtered:
-                    filtered[key] = {'value': 0, 'contract_address': contract_address, 'wallet_addresses': {}}
-                
-                if token['to'].lower() == address.lower():
-                    filtered[key]['value'] += token_value
-                elif token['from'].lower() == address.lower():
-                    filtered[key]['value'] -= token_value
-                
-                filtered[key]['wallet_addresses'][address.lower()] = filtered[key]['value']
-                print(f"Token {key} updated with balance: {filtered[key]['value']}")
-            else:
-                reason = "unwanted content" if re.search(pattern, token_name, re.I) else "excessive length"
-                print(f"Token {token_name} filtered out due to {reason}.")
+        address_lc = address.lower()
+        logger.debug("Filtering tokens for %s", address)
+
+        for token in balances:
+            token_name = token['tokenName']
+            if _SPAM_RE.search(token_name):
+                logger.debug("Token %s filtered out due to unwanted content.", token_name)
+                continue
+            if len(token_name) > self.MAX_TOKEN_NAME_LENGTH:
+                logger.debug("Token %s filtered out due to excessive length.", token_name)
+                continue
+            key = f"{token['tokenSymbol']} ({token_name})"
+            value = token['balance'] / _POW10[int(token['tokenDecimal'])]
+            if key not in filtered:
+                filtered[key] = {'value': 0, 'contract_address': token['contractAddress'], 'wallet_addresses': {}}
+            filtered[key]['value'] += value
+            filtered[key]['wallet_addresses'][address_lc] = filtered[key]['value']
+
+        return filtered
+
+    def filter_tokens(self, tokens, address):
+        address_lc = address.lower()
+        logger.debug("Filtering tokens for %s", address)
+        if not tokens:
+            return {}
+
+        t = pd.DataFrame(tokens)
+        is_spam = t['tokenName'].str.contains(_SPAM_RE, na=False)
+        too_long = t['tokenName'].str.len() > self.MAX_TOKEN_NAME_LENGTH
+        for token_name in t.loc[is_spam, 'tokenName'].unique():
+            logger.debug("Token %s filtered out due to unwanted content.", token_name)
+        for token_name in t.loc[~is_spam & too_long, 'tokenName'].unique():
+            logger.debug("Token %s filtered out due to excessive length.", token_name)
+
+        t = t[~is_spam & ~too_long]
+        t = t.assign(
+            key=t['tokenSymbol'] + " (" + t['tokenName'] + ")",
+            decimals=t['tokenDecimal'].astype(int),
+            signed=t['value'].map(int).astype(object) * np.select(
+                [t['to'].str.lower() == address_lc, t['from'].str.lower() == address_lc], [1, -1], 0
+            )
+        )
+        # Sum raw integer amounts per contract, then scale once by that contract's decimals
+        per_contract = t.groupby(['key', 'contractAddress'], sort=False).agg(units=('signed', 'sum'), decimals=('decimals', 'first'))
 
+        filtered = {}
+        for (key, contract_address), units, decimals in per_contract.itertuples(name=None):
+            if key not in filtered:
+                filtered[key] = {'value': 0, 'contract_address': contract_address, 'wallet_addresses': {}}
+            filtered[key]['value'] += units / _POW10[decimals]
+            filtered[key]['wallet_addresses'][address_lc] = filtered[key]['value']
+            logger.debug("Token %s updated with balance: %s", key, filtered[key]['value'])
         return filtered
 
-    @staticmethod
-    def is_valid_eth_address(address):
-        return address.startswith('0x') and len(address) == 42
+    def fetch_filtered_tokens(self, address):
+        try:
+            if self.alchemy_url:
+                return self.filter_token_balances(self.get_current_token_balances(address), address)
+            tokens = self.get_token_balances(address)
+            return self.filter_tokens(tokens, address)
+        except Exception as e:
+            logger.error("Unexpected error retrieving tokens for %s: %s", address, e)
+        return {}
 
     def sum_token_balances_and_fetch_prices(self):
-        df = pd.read_csv(self.filename)
-        print(f"Loaded {len(df)} addresses from CSV.")
+        if self.addresses is None:
+            wallet_addresses = pd.read_csv(self.filename, dtype=str, keep_default_na=False)['wallet_address']
+            logger.info("Loaded %d addresses from CSV.", len(wallet_addresses))
+        else:
+            wallet_addresses = pd.Series(self.addresses, dtype=str)
+            logger.info("Checking tokens for %d addresses.", len(wallet_addresses))
+            if wallet_addresses.empty:
+                logger.info("No active wallets found; the token report will be empty.")
         total_balances = {}
         unique_tokens = {}
         data_list = []
         all_filtered_tokens = {}
 
-        for address in df['wallet_address']:
-            if not self.is_valid_eth_address(address):
-                print(f"Skipping invalid address: {address}")
+        addresses = []
+        for address in wallet_addresses.str.lower().drop_duplicates():
+            if not is_valid_address(address):
+                logger.warning("Skipping invalid address: %s", address)
                 continue
-            
-            tokens = self.get_token_balances(address)
-            filtered = self.filter_tokens(tokens, address)
+            addresses.append(address)
 
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            filtered_per_address = list(executor.map(self.fetch_filtered_tokens, addresses))
+
+        for filtered in filtered_per_address:
             for token, info in filtered.items():
                 if token not in total_balances:
                     total_balances[token] = 0
@@ -112,22 +298,19 @@ class TokenBalanceChecker:
                 total_balances[token] += info['value']
                 unique_tokens[token] = info['contract_address']
                 all_filtered_tokens[token]['wallet_addresses'].update(info['wallet_addresses'])
-                print(f"Added/Updated balance for {token}, new total: {total_balances[token]}")
+                logger.debug("Added/Updated balance for %s, new total: %s", token, total_balances[token])
 
         # Filter out tokens with a total balance less than 0.01
         initial_token_count = len(total_balances)
         filtered_balances = {token: balance for token, balance in total_balances.items() if balance >= 0.01}
         filtered_token_count = initial_token_count - len(filtered_balances)
-        print(f"Filtered out {filtered_token_count} tokens with a balance < 0.01")
+        logger.info("Filtered out %d tokens with a balance < 0.01", filtered_token_count)
         
         filtered_unique_tokens = {token: addr for token, addr in unique_tokens.items() if token in filtered_balances}
         
-        remaining_calls = len(filtered_unique_tokens)
-        total_prices = {}
-        for token, addr in filtered_unique_tokens.items():
-            total_prices[token] = self.get_token_price(addr, remaining_calls)
-            remaining_calls -= 1
-        print("Completed fetching prices for all tokens.")
+        token_prices = self.get_token_prices(filtered_unique_tokens.values())
+        total_prices = {token: token_prices[addr.lower()] for token, addr in filtered_unique_tokens.items()}
+        logger.info("Completed fetching prices for %d tokens.", len(total_prices))
 
         for token, balance in filtered_balances.items():
             contract_address = unique_tokens[token]
@@ -153,26 +336,32 @@ class TokenBalanceChecker:
                 "Contract Address": contract_address
             })
 
-        result_df = pd.DataFrame(data_list)
+        # Fixed columns keep the report well-formed when no wallet holds any priced token
+        result_df = pd.DataFrame(data_list, columns=["Token", "Balance", "Price", "Total Value", "Wallet Addresses", "Contract Address"])
         result_df = result_df[(result_df['Price'] != "Price data not available") & (result_df['Total Value'] >= 10)]
 
         # Sort the DataFrame by "Total Value" in descending order
         result_df = result_df.sort_values(by="Total Value", ascending=False)
 
-        # Add the total row for "Total Value"
+        # Add the total row for "Total Value" and the date and time as the last row
         total_value_sum = result_df["Total Value"].sum()
-        total_row = pd.DataFrame([{"Token": "Total", "Balance": "", "Price": "", "Total Value": total_value_sum, "Wallet Addresses": "", "Contract Address": ""}])
-        result_df = pd.concat([result_df, total_row], ignore_index=True)
-
-        # Add the date and time to the last row
-        timestamp_row = pd.DataFrame([{"Token": "Timestamp", "Balance": "", "Price": "", "Total Value": self.current_time, "Wallet Addresses": "", "Contract Address": ""}])
-        result_df = pd.concat([result_df, timestamp_row], ignore_index=True)
+        footer = [
+            ("Total", "", "", total_value_sum, "", ""),
+            ("Timestamp", "", "", self.current_time, "", "")
+        ]
 
-        result_df.to_csv(self.output_filename, index=False)
-        print(f"Data saved to {self.output_filename}")
+        with open(self.output_filename, 'w', newline='') as output_file:
+            writer = csv.writer(output_file, lineterminator='\n')
+            writer.writerow(result_df.columns)
+            writer.writerows(result_df.itertuples(index=False, name=None))
+            writer.writerows(footer)
+        if self.owns_session:
+            self.session.close()
+        logger.info("Data saved to %s", self.output_filename)
         return filtered_balances, total_prices
 
 # Example usage:
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     checker = TokenBalanceChecker('config.json')
     checker.sum_token_balances_and_fetch_prices()